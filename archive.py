@@ -0,0 +1,158 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Scott Shawcroft for Adafruit Industries
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import gzip
+import os
+import os.path
+import time
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+# Logs are compressed with gzip and stored under <repo>/<sha>.log.gz.
+def _name(repo, sha):
+    return repo + "/" + sha + ".log.gz"
+
+def _decompress(f, chunk_size=64 * 1024):
+    with gzip.GzipFile(fileobj=f) as g:
+        while True:
+            chunk = g.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+class LocalArchive:
+    def __init__(self, path):
+        self.path = path
+
+    def _path(self, repo, sha):
+        path = os.path.normpath(os.path.join(self.path, _name(repo, sha)))
+        if not path.startswith(os.path.normpath(self.path) + os.sep):
+            raise ValueError("Log path outside of archive: " + path)
+        return path
+
+    def read(self, repo, sha):
+        path = self._path(repo, sha)
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as f:
+            return gzip.decompress(f.read())
+
+    def write(self, repo, sha, data):
+        path = self._path(repo, sha)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial log.
+        try:
+            with open(path + ".tmp", "wb") as f:
+                f.write(gzip.compress(data))
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            try:
+                os.remove(path + ".tmp")
+            except FileNotFoundError:
+                pass
+            raise
+
+    def stream(self, repo, sha):
+        path = self._path(repo, sha)
+        if not os.path.isfile(path):
+            return None
+        def generate():
+            with open(path, "rb") as f:
+                yield from _decompress(f)
+        return generate()
+
+    def prune(self, max_age):
+        cutoff = time.time() - max_age
+        # Temporary files are only left behind by a crash mid-write.
+        tmp_cutoff = time.time() - 60 * 60
+        for root, dirs, files in os.walk(self.path):
+            for fn in files:
+                path = os.path.join(root, fn)
+                try:
+                    if fn.endswith(".log.gz") and os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                    elif fn.endswith(".log.gz.tmp") and os.path.getmtime(path) < tmp_cutoff:
+                        os.remove(path)
+                except FileNotFoundError:
+                    # Rewritten or removed while we were walking the archive.
+                    pass
+
+class S3Archive:
+    def __init__(self, bucket, prefix="", endpoint=None):
+        s3 = boto3.resource("s3", endpoint_url=endpoint,
+                            aws_access_key_id=os.environ.get("AWS_TOKEN"),
+                            aws_secret_access_key=os.environ.get("AWS_SECRET"))
+        self.bucket = s3.Bucket(bucket)
+        self.prefix = prefix
+
+    def _object(self, repo, sha):
+        return self.bucket.Object(self.prefix + _name(repo, sha))
+
+    def _body(self, repo, sha):
+        try:
+            return self._object(repo, sha).get()["Body"]
+        except ClientError as e:
+            # Not every S3-compatible store maps a missing key to NoSuchKey.
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+
+    def read(self, repo, sha):
+        body = self._body(repo, sha)
+        if body is None:
+            return None
+        return gzip.decompress(body.read())
+
+    def write(self, repo, sha, data):
+        self._object(repo, sha).put(Body=gzip.compress(data),
+                                    ContentType="text/plain; charset=utf-8",
+                                    ContentEncoding="gzip")
+
+    def stream(self, repo, sha):
+        # Let the caller fall back to Redis when the store is unavailable.
+        try:
+            body = self._body(repo, sha)
+        except (BotoCoreError, ClientError) as e:
+            print("Unable to fetch archived log for {}/{}: {}".format(repo, sha, e))
+            return None
+        if body is None:
+            return None
+        return _decompress(body)
+
+    def prune(self, max_age):
+        cutoff = time.time() - max_age
+        for obj in self.bucket.objects.filter(Prefix=self.prefix):
+            if obj.key.endswith(".log.gz") and obj.last_modified.timestamp() < cutoff:
+                obj.delete()
+
+def from_config(archive_config):
+    """Build the log archive described by the log-archive section of .rosie.yml.
+       Returns None when logs should stay in Redis."""
+    if not archive_config:
+        return None
+    kind = archive_config.get("type", "local")
+    if kind == "local":
+        return LocalArchive(os.path.abspath(archive_config.get("path", "logs")))
+    elif kind == "s3":
+        return S3Archive(archive_config["bucket"], archive_config.get("prefix", ""), archive_config.get("endpoint"))
+    raise ValueError("Unknown log archive type: " + kind)
@@ -0,0 +1,90 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2017 Scott Shawcroft for Adafruit Industries
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import redis
+import time
+
+redis = redis.StrictRedis()
+
+# Health state for each device lives in a Redis hash so that every worker sees
+# the same view of which boards are misbehaving.
+def _key(board):
+    return "health:" + board["board"] + "-" + str(board["path"])
+
+def _settings(config):
+    overall = config.get("overall", {})
+    return (overall.get("quarantine-after", 3), overall.get("quarantine-seconds", 30 * 60))
+
+def record_success(board, duration):
+    key = _key(board)
+    with redis.pipeline() as p:
+        p.hset(key, "failure_streak", 0)
+        p.hset(key, "last_success", time.time())
+        p.hdel(key, "quarantined_until")
+        p.hincrby(key, "runs", 1)
+        p.hincrbyfloat(key, "total_duration", duration)
+        p.execute()
+
+def record_failure(board, duration, config):
+    """Record a device level failure and quarantine the device once it has
+       failed too many times in a row. Returns True if the device is now
+       quarantined."""
+    key = _key(board)
+    with redis.pipeline() as p:
+        p.hincrby(key, "failure_streak", 1)
+        p.hset(key, "last_failure", time.time())
+        p.hincrby(key, "runs", 1)
+        p.hincrbyfloat(key, "total_duration", duration)
+        streak = p.execute()[0]
+    quarantine_after, quarantine_seconds = _settings(config)
+    if streak < quarantine_after:
+        return False
+    # Once the quarantine lapses the next run acts as a re-probe. Another failure
+    # puts the device right back into quarantine because its streak is still high.
+    redis.hset(key, "quarantined_until", time.time() + quarantine_seconds)
+    return True
+
+def record_lock_timeout(board):
+    """Record giving up on the device lock. Waiting behind a long queue isn't the
+       device's fault so it doesn't count toward the failure streak."""
+    redis.hincrby(_key(board), "lock_timeouts", 1)
+
+def is_quarantined(board):
+    quarantined_until = redis.hget(_key(board), "quarantined_until")
+    return quarantined_until is not None and float(quarantined_until) > time.time()
+
+def get_health(board):
+    raw = {k.decode("utf-8"): v.decode("utf-8") for k, v in redis.hgetall(_key(board)).items()}
+    runs = int(raw.get("runs", 0))
+    total_duration = float(raw.get("total_duration", 0))
+    state = {
+        "board": board["board"],
+        "path": board["path"],
+        "failure_streak": int(raw.get("failure_streak", 0)),
+        "lock_timeouts": int(raw.get("lock_timeouts", 0)),
+        "last_success": float(raw["last_success"]) if "last_success" in raw else None,
+        "last_failure": float(raw["last_failure"]) if "last_failure" in raw else None,
+        "average_duration": total_duration / runs if runs else None,
+        "quarantined": is_quarantined(board),
+        "quarantined_until": float(raw["quarantined_until"]) if "quarantined_until" in raw else None
+    }
+    return state
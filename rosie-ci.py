@@ -29,7 +29,9 @@ import os.path
 import random
 import traceback
 import redis
+from redis.exceptions import WatchError
 import sys
+import time
 
 import sh
 from sh import git
@@ -52,11 +54,14 @@ from werkzeug.utils import secure_filename
 from tasks import make_celery
 
 from celery import group
+from celery.exceptions import SoftTimeLimitExceeded
 from kombu import Queue, Exchange
 
 import boto3
 from botocore.handlers import disable_signing
 
+import archive
+import health
 import tester
 
 app = Flask(__name__)
@@ -83,8 +88,19 @@ anonymous_s3.meta.client.meta.events.register("choose-signer.s3.*", disable_sign
 
 cwd = os.getcwd()
 
+log_archive = archive.from_config(config.get("log-archive"))
+
+# Runs that never reach finish_test are never archived so, when logs are being
+# archived, every log also expires from Redis on its own. Without an archive,
+# logs stay in Redis so the links on GitHub keep working.
+log_ttl = None
+if log_archive is not None:
+    log_ttl = config["log-archive"].get("retention-days", 30) * 24*60*60
+
 def set_status(repo, sha, state, target_url, description):
     redis.append("log:" + repo + "/" + sha, "State %s: %s\n" % (state, description))
+    if log_ttl:
+        redis.expire("log:" + repo + "/" + sha, log_ttl)
     if state == "error":
         print("Run {}/{} errored out: {}".format(repo, sha, description))
     if state in ["pending", "error"]:
@@ -103,6 +119,58 @@ def final_status(repo, sha, state, description):
     # TODO(tannewt): Upload to the public S3 bucket instead. These may disappear.
     set_status(repo, sha, state, "https://rosie-ci.ngrok.io/log/" + repo + "/" + sha, description)
 
+@celery.task(queue="low")
+def archive_log(repo, sha):
+    """Copy a completed run's log into the log archive and then remove it from
+       Redis."""
+    if log_archive is None:
+        return
+    log_key = "log:" + repo + "/" + sha
+    data = redis.get(log_key)
+    if not data:
+        return
+    try:
+        # Reruns of the same commit are appended to the previous log.
+        previous = log_archive.read(repo, sha)
+        if previous:
+            log_archive.write(repo, sha, previous + data)
+        else:
+            log_archive.write(repo, sha, data)
+    except Exception as e:
+        print("Unable to archive log for {}/{}".format(repo, sha))
+        traceback.print_exc()
+        return
+    # Only drop what was archived. Anything appended in the meantime stays in Redis.
+    with redis.pipeline() as p:
+        while True:
+            try:
+                p.watch(log_key)
+                rest = p.getrange(log_key, len(data), -1)
+                p.multi()
+                if rest:
+                    p.set(log_key, rest, ex=log_ttl)
+                else:
+                    p.delete(log_key)
+                p.execute()
+                break
+            except WatchError:
+                continue
+    if "retention-days" in config["log-archive"] and not redis.get("log-archive-pruned"):
+        prune_logs.delay()
+
+@celery.task(queue="low")
+def prune_logs():
+    # Only sweep the archive for old logs once a day.
+    if redis.get("log-archive-pruned"):
+        return
+    try:
+        log_archive.prune(config["log-archive"]["retention-days"] * 24*60*60)
+    except Exception as e:
+        print("Unable to prune log archive")
+        traceback.print_exc()
+        return
+    redis.setex("log-archive-pruned", 24*60*60, "1")
+
 @celery.task(queue="low")
 def load_code(repo, ref):
     print("loading code from " + repo)
@@ -141,8 +209,29 @@ def load_code(repo, ref):
         git.fetch(github_head_url, ref)
     print("loaded", repo, ref)
 
-@celery.task(queue="high")
-def test_board(repo_lock_token, ref=None, repo=None, tag=None, board=None):
+def acquire_device(board):
+    """Try to grab the device lock without waiting. Returns the lock, or None and
+       the reason it couldn't be grabbed: one of "quarantined", "busy" or
+       "redis"."""
+    device_lock = redis.lock("lock:" + board["board"] + "-" + str(board["path"]), timeout=15*60)
+    try:
+        if health.is_quarantined(board):
+            return (None, "quarantined")
+        if not device_lock.acquire(blocking=False):
+            return (None, "busy")
+        # Another run may have quarantined the device while we waited on it.
+        if health.is_quarantined(board):
+            device_lock.release()
+            return (None, "quarantined")
+    except Exception as e:
+        # Redis exception so don't log it.
+        return (None, "redis")
+    return (device_lock, None)
+
+# The soft time limit fires before the 15 minute device lock expires so that a
+# hung run records the failure and releases the device itself.
+@celery.task(bind=True, queue="high", soft_time_limit=14*60, time_limit=15*60)
+def test_board(self, repo_lock_token, ref=None, repo=None, tag=None, board=None):
     base_repo = redis.get("source:" + repo).decode("utf-8")
     repo_path = cwd + "/repos/" + base_repo
     log_key = "log:" + repo + "/" + ref
@@ -155,7 +244,7 @@ def test_board(repo_lock_token, ref=None, repo=None, tag=None, board=None):
 
     if not test_cfg or "binaries" not in test_cfg or not ("prebuilt_s3" in test_cfg["binaries"] or "rosie_upload" in test_cfg["binaries"]):
         redis.append(log_key, "Missing or invalid .rosie.yml in repo.\n")
-        return (repo_lock_token, False, True)
+        return (repo_lock_token, False, True, False)
 
     version = ref[:7]
     if tag is not None:
@@ -167,11 +256,11 @@ def test_board(repo_lock_token, ref=None, repo=None, tag=None, board=None):
             fn = test_cfg["binaries"]["rosie_upload"]["file_pattern"].format(board=board["board"], short_sha=version, version=version, extension="uf2")
         except KeyError as e:
             redis.append(log_key, "Unable to construct filename because of unknown key: {0}\n".format(str(e)))
-            return (repo_lock_token, False, True)
+            return (repo_lock_token, False, True, False)
         except Exception as e:
             e = sys.exc_info()[0]
             redis.append(log_key, "Other error: {0}\n".format(e))
-            return (repo_lock_token, False, True)
+            return (repo_lock_token, False, True, False)
         print("finding file in redis: " + fn)
         redis_file = None
         if "*" in fn:
@@ -195,11 +284,11 @@ def test_board(repo_lock_token, ref=None, repo=None, tag=None, board=None):
             fn = test_cfg["binaries"]["prebuilt_s3"]["file_pattern"].format(board=board["board"], short_sha=version, version=version, extension="uf2")
         except KeyError as e:
             redis.append(log_key, "Unable to construct filename because of unknown key: {0}\n".format(str(e)))
-            return (repo_lock_token, False, True)
+            return (repo_lock_token, False, True, False)
         except Exception as e:
             e = sys.exc_info()[0]
             redis.append(log_key, "Other error: {0}\n".format(e))
-            return (repo_lock_token, False, True)
+            return (repo_lock_token, False, True, False)
         b = anonymous_s3.Bucket(test_cfg["binaries"]["prebuilt_s3"]["bucket"])
         prefix = fn
         suffix = None
@@ -207,7 +296,7 @@ def test_board(repo_lock_token, ref=None, repo=None, tag=None, board=None):
             prefix, suffix = prefix.split("*", 1)
         if suffix and "*" in suffix:
             redis.append(log_key, "Only one * supported in file_pattern")
-            return (repo_lock_token, False, True)
+            return (repo_lock_token, False, True, False)
 
         for obj in b.objects.filter(Prefix=prefix):
             if obj.key.endswith(suffix):
@@ -216,36 +305,76 @@ def test_board(repo_lock_token, ref=None, repo=None, tag=None, board=None):
                     b.download_file(obj.key, tmp_filename)
                 except FileNotFoundError as e:
                     redis.append(log_key, "Unable to download binary for board {0}.".format(board))
-                    return (repo_lock_token, False, True)
+                    return (repo_lock_token, False, True, False)
                 binary = tmp_filename
                 break
     if binary == None:
         redis.append(log_key, "Unable to find binary for board {0}.\n".format(board))
-        return (repo_lock_token, False, True)
+        return (repo_lock_token, False, True, False)
     test_config_ok = True
     tests_ok = True
     # Grab a lock on the device we're using for testing.
     print("waiting for device lock")
-    try:
-        with redis.lock("lock:" + board["board"] + "-" + str(board["path"]), timeout=15*60, blocking_timeout=20*60):
-            print("device lock grabbed")
-            # Run the tests.
+    device_lock, reason = acquire_device(board)
+    skipped = False
+    if reason == "busy" and self.request.retries < 40:
+        # Wait for the device without tying up a worker. The binary is fetched
+        # again on retry.
+        try:
+            os.remove(binary)
+        except FileNotFoundError:
+            pass
+        raise self.retry(countdown=30, max_retries=40)
+    elif reason == "quarantined":
+        redis.append(log_key, "Skipped {0} at {1} because it is quarantined.\n".format(board["board"], board["path"]))
+        skipped = True
+    elif reason == "busy":
+        # A hung run records its own failure so waiting too long isn't the device's fault.
+        redis.append(log_key, "Timed out waiting for {0} at {1}.\n".format(board["board"], board["path"]))
+        try:
+            health.record_lock_timeout(board)
+        except Exception as e:
+            # Redis exception so don't log it.
+            pass
+        test_config_ok = False
+    elif reason == "redis":
+        test_config_ok = False
+    else:
+        print("device lock grabbed")
+        # Run the tests.
+        start_time = time.monotonic()
+        board_ok = False
+        try:
+            tests_ok, board_ok = tester.run_tests(board, binary, test_cfg, log_key=log_key)
+        except SoftTimeLimitExceeded:
+            redis.append(log_key, "Timed out running tests on {0}.\n".format(board["board"]))
+            test_config_ok = False
+        except Exception as e:
+            redis.append(log_key, "Exception while running tests on {0}:\n".format(board["board"]))
+            redis.append(log_key, traceback.format_exc())
+            test_config_ok = False
+        finally:
+            duration = time.monotonic() - start_time
             try:
-                tests_ok = tester.run_tests(board, binary, test_cfg, log_key=log_key)
+                device_lock.release()
             except Exception as e:
-                redis.append(log_key, "Exception while running tests on {0}:\n".format(board["board"]))
-                redis.append(log_key, traceback.format_exc())
-                test_config_ok = False
-    except Exception as e:
-         # Redis exception so don't log it.
-         test_config_ok = False
+                # Redis exception so don't log it.
+                pass
+            try:
+                if board_ok:
+                    health.record_success(board, duration)
+                elif health.record_failure(board, duration, config):
+                    redis.append(log_key, "Quarantined {0} at {1} after repeated failures.\n".format(board["board"], board["path"]))
+            except Exception as e:
+                # Redis exception so don't log it.
+                pass
 
     # Delete the binary since we're done with it.
     try:
         os.remove(binary)
     except FileNotFoundError:
         redis.append(log_key, "Unable to remove file: {0}\n".format(binary))
-    return (repo_lock_token, test_config_ok, tests_ok)
+    return (repo_lock_token, test_config_ok, tests_ok, skipped)
 
 # TODO(tannewt): Switch to separate queues if this causes lock contention.
 @celery.task(bind=True, queue="low")
@@ -279,7 +408,7 @@ def start_test(self, repo, ref):
     return l.local.token.decode("utf-8")
 
 @celery.task(queue="high")
-def finish_test(results, repo, ref):
+def finish_test(results, repo, ref, quarantined=()):
     base_repo = redis.get("source:" + repo).decode("utf-8")
     l = redis.lock(base_repo)
     l.local.token = results[0][0]
@@ -294,16 +423,44 @@ def finish_test(results, repo, ref):
     for result in results:
         test_config_ok = test_config_ok and result[1]
         tests_ok = tests_ok and result[2]
+    # Devices can also be quarantined while their test waited on the lock.
+    skipped_count = len(quarantined) + sum(1 for result in results if result[3])
 
+    skipped = ""
+    if skipped_count:
+        skipped = " Skipped {0} quarantined device(s).".format(skipped_count)
     if not test_config_ok:
-        final_status(repo, ref, "error", "An error occurred while running the tests.")
+        final_status(repo, ref, "error", "An error occurred while running the tests." + skipped)
     elif not tests_ok:
-        final_status(repo, ref, "failure", "One or more tests failed.")
+        final_status(repo, ref, "failure", "One or more tests failed." + skipped)
+    elif all(result[3] for result in results):
+        skip_test(repo, ref)
+        return
     else:
-        final_status(repo, ref, "success", "All tests passed.")
+        final_status(repo, ref, "success", "All tests passed." + skipped)
+    archive_log.delay(repo, ref)
+
+@celery.task(queue="low")
+def skip_test(repo, ref):
+    # GitHub has no neutral status and a success would let an untested commit
+    # through so leave the commit without a status.
+    redis.append("log:" + repo + "/" + ref, "No tests run because all devices are quarantined. Not posting a status.\n")
+    archive_log.delay(repo, ref)
 
 def test_commit(repo, ref, tag):
-    chain = start_test.s(repo, ref) | group(test_board.s(ref=ref, repo=repo, tag=tag, board=board) for board in config["devices"]) | finish_test.s(repo, ref)
+    boards = []
+    quarantined = []
+    for board in config["devices"]:
+        if health.is_quarantined(board):
+            quarantined.append(board["board"] + "-" + str(board["path"]))
+        else:
+            boards.append(board)
+    if quarantined:
+        redis.append("log:" + repo + "/" + ref, "Skipping quarantined devices: {0}\n".format(", ".join(quarantined)))
+    if not boards:
+        skip_test.delay(repo, ref)
+        return
+    chain = start_test.s(repo, ref) | group(test_board.s(ref=ref, repo=repo, tag=tag, board=board) for board in boards) | finish_test.s(repo, ref, quarantined)
     chain.delay()
 
 # Adapted from: https://gist.github.com/andrewgross/8ba32af80ecccb894b82774782e7dcd4
@@ -413,9 +570,28 @@ def rerun(owner, repo, sha):
     test_commit(repo, sha, None)
     return jsonify({"msg": "Ok"})
 
+@app.route("/health", methods=['GET'])
+def device_health():
+    return jsonify([health.get_health(board) for board in config["devices"]])
+
 @app.route("/log/<owner>/<repo>/<sha>", methods=['GET'])
 def log(owner, repo, sha):
-    l = redis.get("log:" + owner + "/" + repo + "/" + sha)
-    if not l:
+    repo = owner + "/" + repo
+    l = redis.get("log:" + repo + "/" + sha)
+    archived = None
+    if log_archive is not None:
+        try:
+            archived = log_archive.stream(repo, sha)
+        except ValueError:
+            abort(404)
+    if not l and archived is None:
         abort(404)
-    return Response(l, mimetype='text/plain; charset=utf-8')
+    if archived is None:
+        return Response(l, mimetype='text/plain; charset=utf-8')
+
+    # Stream the archived log followed by anything from a rerun that's in progress.
+    def generate():
+        yield from archived
+        if l:
+            yield l
+    return Response(generate(), mimetype='text/plain; charset=utf-8')
@@ -71,6 +71,7 @@ def run_circuitpython_tests(log_key, board_name, test_env, mountpoint, disk_devi
                 redis_log(log_key, "Unable to find test helper: {0}\n".format(filename))
 
     tests_ok = True
+    board_ok = True
     outcome = {"passed": 0, "skipped": 0, "failed": 0, "crashed": 0, "timed out": 0}
     for test_file in test_files:
         if os.path.isfile(test_file + ".exp"):
@@ -113,6 +114,7 @@ def run_circuitpython_tests(log_key, board_name, test_env, mountpoint, disk_devi
             tests_ok = False
             outcome["crashed"] += 1
             # TODO(tannewt): Recover out of safe mode and continue tests.
+            board_ok = False
             break
         elif not output.endswith(b"Use CTRL-D to reload.\r\n"):
             redis_log(log_key, test_file + " timed out on " + board_name + ":\n" + output.decode("utf-8") + "\n")
@@ -130,9 +132,10 @@ def run_circuitpython_tests(log_key, board_name, test_env, mountpoint, disk_devi
     test_outcomes = "; ".join([str(outcome[x]) + " tests " + x for x in sorted(outcome.keys())])
     test_outcomes += " on board " + board_name + ".\n"
     redis_log(log_key, test_outcomes)
-    return tests_ok
+    return (tests_ok, board_ok)
 
-# The device is already locked.
+# The device is already locked. Returns whether the tests passed and whether the
+# board is still in a usable state afterwards.
 def run_tests(board, binary, tests, log_key=None):
     serial_device_name = None
     for port in list_ports.comports():
@@ -143,6 +146,7 @@ def run_tests(board, binary, tests, log_key=None):
 
     bootloader = board["bootloader"]
     tests_ok = True
+    board_ok = True
 
     # Trigger the bootloader.
     if bootloader in ("uf2", "samba"):
@@ -174,7 +178,7 @@ def run_tests(board, binary, tests, log_key=None):
         # was flashed.
         start_time = time.monotonic()
         unmounted = False
-        while not unmounted and start_time - time.monotonic() < 30:
+        while not unmounted and time.monotonic() - start_time < 30:
             try:
                 sh.pumount(mountpoint)
                 unmounted = True
@@ -207,10 +211,11 @@ def run_tests(board, binary, tests, log_key=None):
             if not serial_device_name:
                 raise RuntimeError("No CircuitPython serial connection found at path: " + board["path"])
             with serial.Serial("/dev/" + serial_device_name, 115200, write_timeout=4, timeout=4) as conn:
-                tests_ok = run_circuitpython_tests(log_key, board["board"], board["test_env"], mountpoint, disk_device, conn, tests["circuitpython_tests"]) and tests_ok
+                cpy_tests_ok, board_ok = run_circuitpython_tests(log_key, board["board"], board["test_env"], mountpoint, disk_device, conn, tests["circuitpython_tests"])
+                tests_ok = cpy_tests_ok and tests_ok
 
 
-    return tests_ok
+    return (tests_ok, board_ok)
 
 if __name__ == "__main__":
     pass